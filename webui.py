@@ -1,4 +1,5 @@
 import argparse
+import importlib.util
 import os
 import sys
 from pathlib import Path
@@ -38,15 +39,32 @@ import traceback
 from datetime import datetime
 from enum import IntEnum
 from typing import Optional
-from collections import namedtuple
+from collections import namedtuple, deque
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import nullcontext
+from functools import lru_cache
 import signal
 import tqdm
 import re
 import threading
 import base64
+import zlib
+import itertools
+import hashlib
 from io import BytesIO
 
+try:
+    # optional; only used to read and write the settings file
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    # optional; a vectorized base64 encoder for images embedded in history entries
+    import pybase64
+except ImportError:
+    pybase64 = None
+
 import k_diffusion.sampling
 from ldm.util import instantiate_from_config
 from ldm.models.diffusion.ddim import DDIMSampler
@@ -62,6 +80,8 @@ opt_f = 8
 
 LANCZOS = (Image.Resampling.LANCZOS if hasattr(Image, 'Resampling') else Image.LANCZOS)
 invalid_filename_chars = '<>:"/\\|?*\n'
+# spaces become underscores and invalid characters are dropped in a single translate() pass
+invalid_filename_chars_table = str.maketrans(' ', '_', invalid_filename_chars)
 config_filename = "config.json"
 
 parser = argparse.ArgumentParser()
@@ -78,6 +98,9 @@ parser.add_argument("--medvram", action='store_true', help="enable stable diffus
 parser.add_argument("--lowvram", action='store_true', help="enable stable diffusion model optimizations for sacrficing a lot of speed for very low VRM usage")
 parser.add_argument("--always-batch-cond-uncond", action='store_true', help="a workaround test; may help with speed in you use --lowvram")
 parser.add_argument("--precision", type=str, help="evaluate at this precision", choices=["full", "autocast"], default="autocast")
+parser.add_argument("--compile", action='store_true', help="compile the UNet and VAE decoder with torch.compile (needs torch 2.0+); first generation at every new image size will be slow")
+parser.add_argument("--compile-mode", type=str, help="torch.compile mode for --compile; reduce-overhead also captures the UNet into CUDA graphs, which removes most per-step launch overhead at the cost of memory", choices=["default", "reduce-overhead", "max-autotune"], default="default")
+parser.add_argument("--int8", action='store_true', help="quantize linear layers of the UNet to 8 bits with bitsandbytes; halves their memory traffic at a small cost in quality")
 parser.add_argument("--share", action='store_true', help="use share=True for gradio and make the UI accessible through their site (doesn't work for me but you might have better luck)")
 cmd_opts = parser.parse_args()
 
@@ -85,6 +108,11 @@ cpu = torch.device("cpu")
 gpu = torch.device("cuda")
 device = gpu if torch.cuda.is_available() else cpu
 batch_cond_uncond = cmd_opts.always_batch_cond_uncond or not (cmd_opts.lowvram or cmd_opts.medvram)
+
+# input shapes stay the same for the whole generation, so let cuDNN pick the fastest convolution algorithms for them;
+# grad mode is per-thread and gradio calls us from worker threads, so process_images also sets its own scope
+torch.backends.cudnn.benchmark = True
+torch.set_grad_enabled(False)
 queue_lock = threading.Lock()
 
 class State:
@@ -117,37 +145,48 @@ samplers = [
 ]
 samplers_for_img2img = [x for x in samplers if x.name != 'PLMS']
 
+
+@lru_cache(maxsize=1)
+def create_sampler(sampler_data):
+    """the last used sampler is kept, so that repeated generations with it don't set it up from scratch"""
+    return sampler_data.constructor()
+
+
 RealesrganModelInfo = namedtuple("RealesrganModelInfo", ["name", "location", "model", "netscale"])
 
-try:
+
+def realesrgan_rrdbnet(num_block, scale):
     from basicsr.archs.rrdbnet_arch import RRDBNet
-    from realesrgan import RealESRGANer
-    from realesrgan.archs.srvgg_arch import SRVGGNetCompact
 
+    return RRDBNet(num_in_ch=3, num_out_ch=3, num_feat=64, num_block=num_block, num_grow_ch=32, scale=scale)
+
+
+# Real-ESRGAN and GFPGAN bring in basicsr and a lot of torch code with them, so at startup we only check that
+# they are installed; the actual imports happen the first time they are used
+have_realesrgan = all(importlib.util.find_spec(x) is not None for x in ['basicsr', 'realesrgan'])
+
+if have_realesrgan:
     realesrgan_models = [
         RealesrganModelInfo(
             name="Real-ESRGAN 2x plus",
             location="https://github.com/xinntao/Real-ESRGAN/releases/download/v0.2.1/RealESRGAN_x2plus.pth",
-            netscale=2, model=lambda: RRDBNet(num_in_ch=3, num_out_ch=3, num_feat=64, num_block=23, num_grow_ch=32, scale=2)
+            netscale=2, model=lambda: realesrgan_rrdbnet(num_block=23, scale=2)
         ),
         RealesrganModelInfo(
             name="Real-ESRGAN 4x plus",
             location="https://github.com/xinntao/Real-ESRGAN/releases/download/v0.1.0/RealESRGAN_x4plus.pth",
-            netscale=4, model=lambda: RRDBNet(num_in_ch=3, num_out_ch=3, num_feat=64, num_block=23, num_grow_ch=32, scale=4)
+            netscale=4, model=lambda: realesrgan_rrdbnet(num_block=23, scale=4)
         ),
         RealesrganModelInfo(
             name="Real-ESRGAN 4x plus anime 6B",
             location="https://github.com/xinntao/Real-ESRGAN/releases/download/v0.2.2.4/RealESRGAN_x4plus_anime_6B.pth",
-            netscale=4, model=lambda: RRDBNet(num_in_ch=3, num_out_ch=3, num_feat=64, num_block=6, num_grow_ch=32, scale=4)
+            netscale=4, model=lambda: realesrgan_rrdbnet(num_block=6, scale=4)
         ),
     ]
-    have_realesrgan = True
-except Exception:
-    print("Error importing Real-ESRGAN:", file=sys.stderr)
-    print(traceback.format_exc(), file=sys.stderr)
+else:
+    print("Warning: Real-ESRGAN not found; install basicsr and realesrgan to use it", file=sys.stderr)
 
     realesrgan_models = [RealesrganModelInfo('None', '', 0, None)]
-    have_realesrgan = False
 
 sd_upscalers = {
     "RealESRGAN": lambda img: upscale_with_realesrgan(img, 2, 0),
@@ -156,7 +195,9 @@ sd_upscalers = {
 }
 
 
+@lru_cache(maxsize=1)
 def gfpgan_model_path():
+    """where the GFPGAN model is; it only depends on command line options, so it is looked up once"""
     places = [script_path, '.', os.path.join(cmd_opts.gfpgan_dir, 'experiments/pretrained_models')]
     files = [cmd_opts.gfpgan_model] + [os.path.join(dirname, cmd_opts.gfpgan_model) for dirname in places]
     found = [x for x in files if os.path.exists(x)]
@@ -168,10 +209,13 @@ def gfpgan_model_path():
 
 
 def gfpgan():
+    from gfpgan import GFPGANer
+
     return GFPGANer(model_path=gfpgan_model_path(), upscale=1, arch='clean', channel_multiplier=2, bg_upsampler=None)
 
-def gfpgan_fix_faces(gfpgan_model, np_image):
-    np_image_bgr = np_image[:, :, ::-1]
+def gfpgan_fix_faces(gfpgan_model, np_image, is_bgr=False):
+    # GFPGAN's OpenCV code would make its own contiguous copy of a reversed view, so one is made here, once
+    np_image_bgr = np_image if is_bgr else np.ascontiguousarray(np_image[:, :, ::-1])
     cropped_faces, restored_faces, gfpgan_output_bgr = gfpgan_model.enhance(np_image_bgr, has_aligned=False, only_center_face=False, paste_back=True)
     np_image = gfpgan_output_bgr[:, :, ::-1]
 
@@ -183,7 +227,9 @@ try:
 
     if os.path.exists(cmd_opts.gfpgan_dir):
         sys.path.append(os.path.abspath(cmd_opts.gfpgan_dir))
-    from gfpgan import GFPGANer
+
+    if importlib.util.find_spec('gfpgan') is None:
+        raise ModuleNotFoundError("No module named 'gfpgan'")
 
     have_gfpgan = True
 except Exception:
@@ -221,6 +267,7 @@ class Options:
         "grid_only_if_multiple": OptionInfo(True, "Do not save grids consisting of one picture"),
         "n_rows": OptionInfo(-1, "Grid row count; use -1 for autodetect and 0 for it to be same as batch size", gr.Slider, {"minimum": -1, "maximum": 16, "step": 1}),
         "jpeg_quality": OptionInfo(80, "Quality for saved jpeg images", gr.Slider, {"minimum": 1, "maximum": 100, "step": 1}),
+        "png_compression": OptionInfo(1, "Compression level for saved png images; higher is smaller but takes longer to save", gr.Slider, {"minimum": 0, "maximum": 9, "step": 1}),
         "export_for_4chan": OptionInfo(True, "If PNG image is larger than 4MB or any dimension is larger than 4000, downscale and save copy as JPG"),
         "enable_pnginfo": OptionInfo(True, "Save text information about generation parameters as chunks to png files"),
         "font": OptionInfo("arial.ttf", "Font for image grids  that have text"),
@@ -229,6 +276,7 @@ class Options:
         "sd_upscale_overlap": OptionInfo(64, "Overlap for tiles for SD upscale. The smaller it is, the less smooth transition from one tile to another", gr.Slider, {"minimum": 0, "maximum": 256, "step": 16}),
         "enable_history": OptionInfo(True, "Enable saving prompt history and thumbnails for txt2img"),
         "history_thumbnail_res": OptionInfo(64, "Set the resolution (in pixels) of thumbnails for the History tab (restart and refresh required)", gr.Slider, {"minimum": 64, "maximum": 128, "step": 32}),
+        "history_max_shown": OptionInfo(100, "Number of most recent entries shown in the History tab; 0 shows all of them"),
         # TODO: Remove this and make it part of the Syntactic prompts settings
         "enable_emphasis": OptionInfo(True, "Use (text) to make model pay more attention to text text and [text] to make it pay less attention"),
         "save_txt": OptionInfo(False, "Create a text file next to every image with generation parameters."),
@@ -255,25 +303,52 @@ class Options:
         return super(Options, self).__getattribute__(item)
 
     def save(self, filename):
-        with open(filename, "w", encoding="utf8") as file:
-            json.dump(self.data, file)
+        data = orjson.dumps(self.data) if orjson is not None else json.dumps(self.data).encode("utf8")
+        with open(filename, "wb") as file:
+            file.write(data)
 
     def load(self, filename):
-        with open(filename, "r", encoding="utf8") as file:
-            self.data = json.load(file)
+        with open(filename, "rb") as file:
+            data = file.read()
+
+        self.data = orjson.loads(data) if orjson is not None else json.loads(data)
 
 opts = Options()
 if os.path.exists(config_filename):
     opts.load(config_filename)
 
+
+def prefetch_file(path):
+    """read a file through once, so that its pages are in the OS cache by the time they are needed"""
+    buffer = bytearray(16 * 1024 * 1024)
+    with open(path, "rb", buffering=0) as file:
+        while file.readinto(buffer):
+            pass
+
+
 def load_model_from_config(config, ckpt, verbose=False):
     print(f"Loading model from {ckpt}")
-    pl_sd = torch.load(ckpt, map_location="cpu")
+
+    # the checkpoint is read from disk in the background while the model is being constructed
+    threading.Thread(target=prefetch_file, args=(ckpt,), daemon=True).start()
+    model = instantiate_from_config(config.model)
+
+    try:
+        # map the checkpoint into memory instead of reading all of it into RAM before copying it into the model;
+        # needs torch 2.1+ and a zipfile-format checkpoint, otherwise load it the old way
+        pl_sd = torch.load(ckpt, map_location="cpu", mmap=True)
+    except (TypeError, RuntimeError):
+        pl_sd = torch.load(ckpt, map_location="cpu")
+
     if "global_step" in pl_sd:
         print(f"Global Step: {pl_sd['global_step']}")
     sd = pl_sd["state_dict"]
-    model = instantiate_from_config(config.model)
-    m, u = model.load_state_dict(sd, strict=False)
+    try:
+        # with assign, the model takes over the checkpoint's tensors instead of copying them into its own
+        m, u = model.load_state_dict(sd, strict=False, assign=True)
+    except TypeError:
+        m, u = model.load_state_dict(sd, strict=False)
+    del pl_sd, sd
     if len(m) > 0 and verbose:
         print("missing keys:")
         print(m)
@@ -285,12 +360,101 @@ def load_model_from_config(config, ckpt, verbose=False):
     return model
 
 
+def quantize_linear_layers(model):
+    """replace linear layers with 8-bit bitsandbytes ones; time embeddings and attention output projections stay as they
+    are, since they are small and quantizing them costs the most quality
+    """
+    import bitsandbytes as bnb
+
+    for name, module in list(model.named_modules()):
+        if name.startswith('time_embed') or name.endswith('to_out'):
+            continue
+
+        for child_name, child in list(module.named_children()):
+            if type(child) is not nn.Linear:
+                continue
+
+            layer = bnb.nn.Linear8bitLt(child.in_features, child.out_features, bias=child.bias is not None, has_fp16_weights=False, threshold=6.0)
+            # weights get quantized on their way to the GPU, so they are handed over from the CPU
+            layer.weight = bnb.nn.Int8Params(child.weight.data.cpu(), requires_grad=False, has_fp16_weights=False)
+            if child.bias is not None:
+                layer.bias = nn.Parameter(child.bias.data, requires_grad=False)
+
+            setattr(module, child_name, layer.to(child.weight.device))
+
+
 module_in_gpu = None
 
 
 def setup_for_low_vram(sd_model):
     parents = {}
 
+    # weights never change, so the CPU tensors of every module moved by the hooks are kept around, page-locked;
+    # copies to GPU come from them without blocking, and moving a module back to CPU just points it at them again
+    pinned = {}
+
+    def pin_module(module):
+        """move the module's parameters and buffers into a single CPU buffer that takes the place of their own storage,
+        so there is still one CPU copy of them; the buffer is page-locked in place at its exact size, which torch's
+        pinned allocator would round up to a power of two, and stays pageable if the system refuses to lock that much
+        """
+        tensors = list(itertools.chain(module.parameters(), module.buffers()))
+
+        # every tensor starts 64 byte aligned, so that it can be viewed as any dtype
+        offsets = []
+        size = 0
+        for tensor in tensors:
+            offsets.append(size)
+            size += (tensor.numel() * tensor.element_size() + 63) // 64 * 64
+
+        # a failed registration only returns an error code; older torch builds don't have the binding at all
+        buffer = torch.empty(size, dtype=torch.uint8)
+        try:
+            torch.cuda.cudart().cudaHostRegister(buffer.data_ptr(), size, 0)
+        except (AttributeError, RuntimeError):
+            pass
+
+        for tensor, offset in zip(tensors, offsets):
+            data = buffer[offset:offset + tensor.numel() * tensor.element_size()].view(tensor.dtype)
+
+            # channels_last weights keep their layout
+            dense = tensor.is_contiguous() or (tensor.dim() == 4 and tensor.is_contiguous(memory_format=torch.channels_last))
+            data = data.as_strided(tensor.shape, tensor.stride()) if dense else data.view(tensor.shape)
+
+            data.copy_(tensor.data)
+            tensor.data = data
+
+        return [(tensor, tensor.data) for tensor in tensors]
+
+    # uploads go on their own stream, so they start right away instead of queueing up behind the kernels of the
+    # module that is being evicted, which may still be running
+    upload_stream = torch.cuda.Stream() if device.type == 'cuda' else None
+
+    def move_module(module, target):
+        if device.type != 'cuda':
+            module.to(target)
+            return
+
+        if module not in pinned:
+            pinned[module] = pin_module(module)
+
+        if target == cpu:
+            for tensor, pinned_data in pinned[module]:
+                tensor.data = pinned_data
+            return
+
+        with torch.cuda.stream(upload_stream):
+            for tensor, pinned_data in pinned[module]:
+                tensor.data = pinned_data.to(target, non_blocking=True)
+
+        compute_stream = torch.cuda.current_stream()
+        compute_stream.wait_stream(upload_stream)
+
+        # the weights were allocated on the upload stream; this keeps their memory from being handed out to the next
+        # upload after eviction while the compute stream may still be reading them
+        for tensor, pinned_data in pinned[module]:
+            tensor.data.record_stream(compute_stream)
+
     def send_me_to_gpu(module, _):
         """send this module to GPU; send whatever tracked module was previous in GPU to CPU;
         we add this as forward_pre_hook to a lot of modules and this way all but one of them will
@@ -304,9 +468,9 @@ def setup_for_low_vram(sd_model):
             return
 
         if module_in_gpu is not None:
-            module_in_gpu.to(cpu)
+            move_module(module_in_gpu, cpu)
 
-        module.to(gpu)
+        move_module(module, gpu)
         module_in_gpu = module
 
     # see below for register_forward_pre_hook;
@@ -355,24 +519,149 @@ def setup_for_low_vram(sd_model):
             block.register_forward_pre_hook(send_me_to_gpu)
 
 
-def create_random_tensors(shape, seeds):
-    xs = []
-    for seed in seeds:
+def create_random_tensors(shape, seeds, out=None):
+    """one normally distributed tensor of the given shape per seed, stacked; if out is given, its leading
+    len(seeds) entries are filled instead of allocating a new tensor
+    """
+    x = out[:len(seeds)] if out is not None else torch.empty((len(seeds),) + tuple(shape), device=device)
+
+    # the global RNG is seeded for every sample as before, not a generator of our own: ancestral k-diffusion samplers
+    # draw their per-step noise from it, so it has to be left seeded with the last seed for results to reproduce
+    for i, seed in enumerate(seeds):
         torch.manual_seed(seed)
 
         # randn results depend on device; gpu and cpu get different results for same seed;
         # the way I see it, it's better to do this on CPU, so that everyone gets same result;
         # but the original script had it like this so i do not dare change it for now because
         # it will break everyone's seeds.
-        xs.append(torch.randn(shape, device=device))
-    x = torch.stack(xs)
+        x[i].normal_()
+
     return x
 
 
+def decode_first_stage(model, x):
+    """decode latents with the first stage model; in low VRAM modes it is done one sample at a time into a preallocated
+    output, so that decoder activations for only one image are alive at once
+    """
+    if not (cmd_opts.lowvram or cmd_opts.medvram) or x.shape[0] == 1:
+        return model.decode_first_stage(x)
+
+    first = model.decode_first_stage(x[0:1])
+    decoded = torch.empty((x.shape[0],) + tuple(first.shape[1:]), dtype=first.dtype, device=first.device)
+    decoded[0:1] = first
+    del first
+
+    for i in range(1, x.shape[0]):
+        decoded[i:i + 1] = model.decode_first_stage(x[i:i + 1])
+
+    return decoded
+
+
+# VAE encoder outputs for the last few init image batches, keyed by a digest of their pixels
+first_stage_posteriors = {}
+
+
+def encode_first_stage(model, batch_images):
+    """encode a batch of HWC uint8 images; the same init image tends to be submitted again and again, so the encoder
+    output is cached, while the latent is still sampled from it anew every time
+    """
+    key = (batch_images.shape, hashlib.blake2b(np.ascontiguousarray(batch_images)).digest())
+
+    posterior = first_stage_posteriors.get(key)
+    if posterior is None:
+        # images travel to the GPU as HWC uint8, a quarter of the size of floats, and are converted to CHW [-1, 1] there;
+        # the mapping is done in float32 like the original 2 * (x / 255) - 1, and only its result is cast to the model's dtype
+        image = to_device_non_blocking(torch.from_numpy(batch_images))
+        image = image.permute(0, 3, 1, 2).float().div_(255.0).mul_(2.0).sub_(1.0).to(model.dtype)
+
+        posterior = model.encode_first_stage(image)
+
+        if len(first_stage_posteriors) >= 4:
+            del first_stage_posteriors[next(iter(first_stage_posteriors))]
+        first_stage_posteriors[key] = posterior
+
+    return model.get_first_stage_encoding(posterior)
+
+
+def to_device_non_blocking(tensor):
+    """copy a CPU tensor to device via pinned memory so the host does not wait for the transfer;
+    pinned blocks come from torch's caching host allocator, which won't hand a block out again until its copy is done
+    """
+    if device.type != 'cuda':
+        return tensor.to(device)
+
+    return tensor.pin_memory().to(device, non_blocking=True)
+
+
+def stack_images_pinned(imgs):
+    """stack HWC uint8 images into one array that, when running on a GPU, lives in pinned memory; batches sliced out of
+    it are then copied to the device straight from it by to_device_non_blocking, with no staging copy per batch
+    """
+    images = torch.empty((len(imgs),) + imgs[0].shape, dtype=torch.uint8, pin_memory=device.type == 'cuda').numpy()
+    for i, img in enumerate(imgs):
+        images[i] = img
+
+    return images
+
+
+# generated images are copied back to the CPU on their own stream, so the copy can overlap with sampling of the next batch
+copy_stream = torch.cuda.Stream() if device.type == 'cuda' else None
+
+
+def to_host_non_blocking(tensor):
+    """start copying a device tensor into pinned memory; returns the copy along with an event that has to be
+    synchronized before the copy is read, or None if the copy was done synchronously
+    """
+    if copy_stream is None:
+        return tensor.cpu(), None
+
+    copy_stream.wait_stream(torch.cuda.current_stream())
+    with torch.cuda.stream(copy_stream):
+        host = torch.empty(tensor.shape, dtype=tensor.dtype, pin_memory=True)
+        host.copy_(tensor, non_blocking=True)
+        copied = torch.cuda.Event()
+        copied.record(copy_stream)
+
+    # keeps the caching allocator from reusing the source memory for the next batch before the copy has finished
+    tensor.record_stream(copy_stream)
+
+    return host, copied
+
+
 def torch_gc():
-    if torch.cuda.is_available():
+    # empty_cache can only give back memory that is reserved but unused; below this much it isn't worth the trouble
+    # of having torch reallocate it later
+    if torch.cuda.is_available() and torch.cuda.memory_reserved() - torch.cuda.memory_allocated() > 256 * 1024 * 1024:
         torch.cuda.empty_cache()
-        torch.cuda.ipc_collect()
+
+
+# directory -> (mtime_ns, file count) as last seen or written by save_image
+dir_file_counts = {}
+
+
+def count_files(path):
+    """number of files in directory; only lists it again if something else has changed it since we last looked"""
+    mtime = os.stat(path).st_mtime_ns
+    cached = dir_file_counts.get(path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    with os.scandir(path) as entries:
+        count = sum(1 for _ in entries)
+    dir_file_counts[path] = (mtime, count)
+    return count
+
+
+# images are encoded and written on this thread while the GPU works on the next batch; a single worker keeps
+# saves in order and file numbering in save_image free of races
+save_image_executor = ThreadPoolExecutor(max_workers=1)
+
+
+def save_image_in_background(*args, **kwargs):
+    """queue an image to be saved by save_image on the save thread; returns its future, which the caller has to wait on
+    before the request finishes, so that an error from saving is reported like any other error of the request
+    """
+    return save_image_executor.submit(save_image, *args, **kwargs)
 
 
 def save_image(image, path, basename, seed=None, prompt=None, extension='png', info=None, short_filename=False, no_prompt=False):
@@ -399,71 +688,91 @@ def save_image(image, path, basename, seed=None, prompt=None, extension='png', i
 
     os.makedirs(path, exist_ok=True)
 
-    filecount = len(os.listdir(path))
-    fullfn = "a.png"
-    fullfn_without_extension = "a"
+    filecount = count_files(path)
     for i in range(100):
         fn = f"{filecount:05}" if basename == '' else f"{basename}-{filecount:04}"
         fullfn = os.path.join(path, f"{fn}{file_decoration}.{extension}")
         fullfn_without_extension = os.path.join(path, f"{fn}{file_decoration}")
-        if not os.path.exists(fullfn):
+
+        # creating the file exclusively claims the name in the same call that checks it is free, so saves
+        # from the save thread and from the main thread can't end up writing to the same file
+        try:
+            file = open(fullfn, "xb")
             break
+        except FileExistsError:
+            filecount += 1
+    else:
+        file = open(fullfn, "wb")
 
-    image.save(fullfn, quality=opts.jpeg_quality, pnginfo=pnginfo)
+    with file:
+        image.save(file, quality=opts.jpeg_quality, compress_level=int(opts.png_compression), pnginfo=pnginfo)
+    files_written = 1
 
     target_side_length = 4000
     oversize = image.width > target_side_length or image.height > target_side_length
     if opts.export_for_4chan and (oversize or os.stat(fullfn).st_size > 4 * 1024 * 1024):
         ratio = image.width / image.height
 
+        # reducing_gap has PIL shrink by an integer factor with a cheap box filter first, and only run LANCZOS on
+        # what is left, which is much faster for large ratios while looking the same
         if oversize and ratio > 1:
-            image = image.resize((target_side_length, image.height * target_side_length // image.width), LANCZOS)
+            image = image.resize((target_side_length, image.height * target_side_length // image.width), LANCZOS, reducing_gap=3.0)
         elif oversize:
-            image = image.resize((image.width * target_side_length // image.height, target_side_length), LANCZOS)
+            image = image.resize((image.width * target_side_length // image.height, target_side_length), LANCZOS, reducing_gap=3.0)
 
         image.save(f"{fullfn_without_extension}.jpg", quality=opts.jpeg_quality, pnginfo=pnginfo)
+        files_written += 1
 
     if opts.save_txt and info is not None:
         with open(f"{fullfn_without_extension}.txt", "w", encoding="utf-8") as file:
             file.write(info + "\n")
 
+        files_written += 1
+
+    dir_file_counts[path] = (os.stat(path).st_mtime_ns, filecount + files_written)
+
 def sanitize_filename_part(text):
-    return text.replace(' ', '_').translate({ord(x): '' for x in invalid_filename_chars})[:128]
+    return text.translate(invalid_filename_chars_table)[:128]
 
 
 def plaintext_to_html(text, klass=None):
-    if klass is None:
-        text = "".join([f"<p>{html.escape(x)}</p>\n" for x in text.split('\n')])
+    # escaping leaves newlines alone, so the whole text is escaped at once and split into paragraphs after
+    tag = "<p>" if klass is None else f"<p class=\"{klass}\">"
+    return "".join(f"{tag}{x}</p>\n" for x in html.escape(text).split('\n'))
+
+
+def image_grid_rows(count, batch_size=1):
+    if opts.n_rows > 0:
+        return opts.n_rows
+    elif opts.n_rows == 0:
+        return batch_size
     else:
-        text = "".join([f"<p class=\"{klass}\">{html.escape(x)}</p>\n" for x in text.split('\n')])
-    return text
+        return round(math.sqrt(count))
 
 
 def image_grid(imgs, batch_size=1, rows=None):
     if rows is None:
-        if opts.n_rows > 0:
-            rows = opts.n_rows
-        elif opts.n_rows == 0:
-            rows = batch_size
-        else:
-            rows = math.sqrt(len(imgs))
-            rows = round(rows)
+        rows = image_grid_rows(len(imgs), batch_size)
 
     cols = math.ceil(len(imgs) / rows)
 
     w, h = imgs[0].size
-    grid = Image.new('RGB', size=(cols * w, rows * h), color='black')
+    grid = np.zeros((rows * h, cols * w, 3), dtype=np.uint8)
 
     for i, img in enumerate(imgs):
-        grid.paste(img, box=(i % cols * w, i // cols * h))
+        y, x = i // cols * h, i % cols * w
+        grid[y:y + h, x:x + w] = np.asarray(img)
 
-    return grid
+    return Image.fromarray(grid)
 
 
-Grid = namedtuple("Grid", ["tiles", "tile_w", "tile_h", "image_w", "image_h", "overlap"])
+Grid = namedtuple("Grid", ["xs", "ys", "tiles", "tile_w", "tile_h", "image_w", "image_h", "overlap"])
 
 
 def split_grid(image, tile_w=512, tile_h=512, overlap=64):
+    """cut image into overlapping tiles; grid.tiles is a uint8 array of shape (rows, cols, tile_h, tile_w, 3),
+    and the tile at [row, col] has its top left corner at (grid.xs[col], grid.ys[row])
+    """
     w = image.width
     h = image.height
 
@@ -473,58 +782,71 @@ def split_grid(image, tile_w=512, tile_h=512, overlap=64):
     cols = math.ceil((w - overlap) / now)
     rows = math.ceil((h - overlap) / noh)
 
-    grid = Grid([], tile_w, tile_h, w, h, overlap)
-    for row in range(rows):
-        row_images = []
+    # an image smaller than a tile is padded with black so that every tile lies inside the array
+    pixels = np.asarray(to_rgb(image))
+    if w < tile_w or h < tile_h:
+        pixels = np.pad(pixels, ((0, max(tile_h - h, 0)), (0, max(tile_w - w, 0)), (0, 0)))
 
-        y = row * noh
+    xs = [min(col * now, pixels.shape[1] - tile_w) for col in range(cols)]
+    ys = [min(row * noh, pixels.shape[0] - tile_h) for row in range(rows)]
 
-        if y + tile_h >= h:
-            y = h - tile_h
+    tiles = np.empty((rows, cols, tile_h, tile_w, 3), dtype=np.uint8)
+    for row, y in enumerate(ys):
+        for col, x in enumerate(xs):
+            tiles[row, col] = pixels[y:y + tile_h, x:x + tile_w]
 
-        for col in range(cols):
-            x = col * now
+    return Grid(xs, ys, tiles, tile_w, tile_h, w, h, overlap)
 
-            if x + tile_w >= w:
-                x = w - tile_w
 
-            tile = image.crop((x, y, x + tile_w, y + tile_h))
-
-            row_images.append([x, tile_w, tile])
-
-        grid.tiles.append([y, tile_h, row_images])
-
-    return grid
+@lru_cache(maxsize=16)
+def grid_blend_mask(overlap):
+    """blending weights for the overlapping band of two tiles, same values PIL would get from an 'L' mask image"""
+    mask = np.arange(overlap, dtype=np.uint16) * 255 // max(overlap, 1)
+    mask.flags.writeable = False
+    return mask
 
 
 def combine_grid(grid):
-    def make_mask_image(r):
-        r = r * 255 / grid.overlap
-        r = r.astype(np.uint8)
-        return Image.fromarray(r, 'L')
-
-    mask_w = make_mask_image(np.arange(grid.overlap, dtype=np.float32).reshape((1, grid.overlap)).repeat(grid.tile_h, axis=0))
-    mask_h = make_mask_image(np.arange(grid.overlap, dtype=np.float32).reshape((grid.overlap, 1)).repeat(grid.image_w, axis=1))
-
-    combined_image = Image.new("RGB", (grid.image_w, grid.image_h))
-    for y, h, row in grid.tiles:
-        combined_row = Image.new("RGB", (grid.image_w, h))
-        for x, w, tile in row:
+    mask = grid_blend_mask(grid.overlap)
+    mask_w = mask.reshape((1, grid.overlap, 1))
+    mask_h = mask.reshape((grid.overlap, 1, 1))
+
+    def blend(dst, src, m):
+        # 255 * 255 + 127 still fits in uint16, so the whole blend is done in uint16 and written back in place
+        blended = src * m
+        blended += dst * (255 - m)
+        blended += 127
+        blended //= 255
+        dst[...] = blended
+
+    w, h = grid.tile_w, grid.tile_h
+    combined_image = np.zeros((max(grid.image_h, h), max(grid.image_w, w), 3), dtype=np.uint8)
+    # tiles cover a row completely, so one buffer is reused for all rows
+    combined_row = np.empty((h, combined_image.shape[1], 3), dtype=np.uint8)
+    for row, y in enumerate(grid.ys):
+        for col, x in enumerate(grid.xs):
+            tile = grid.tiles[row, col]
+
             if x == 0:
-                combined_row.paste(tile, (0, 0))
+                combined_row[:, 0:w] = tile
                 continue
 
-            combined_row.paste(tile.crop((0, 0, grid.overlap, h)), (x, 0), mask=mask_w)
-            combined_row.paste(tile.crop((grid.overlap, 0, w, h)), (x + grid.overlap, 0))
+            blend(combined_row[:, x:x + grid.overlap], tile[:, 0:grid.overlap], mask_w)
+            combined_row[:, x + grid.overlap:x + w] = tile[:, grid.overlap:w]
 
         if y == 0:
-            combined_image.paste(combined_row, (0, 0))
+            combined_image[0:h] = combined_row
             continue
 
-        combined_image.paste(combined_row.crop((0, 0, combined_row.width, grid.overlap)), (0, y), mask=mask_h)
-        combined_image.paste(combined_row.crop((0, grid.overlap, combined_row.width, h)), (0, y + grid.overlap))
+        blend(combined_image[y:y + grid.overlap], combined_row[0:grid.overlap], mask_h)
+        combined_image[y + grid.overlap:y + h] = combined_row[grid.overlap:h]
+
+    return Image.fromarray(combined_image[0:grid.image_h, 0:grid.image_w])
 
-    return combined_image
+
+@lru_cache(maxsize=16)
+def get_font(fontname, fontsize):
+    return ImageFont.truetype(fontname, fontsize)
 
 
 class GridAnnotation:
@@ -535,14 +857,38 @@ class GridAnnotation:
 
 
 def draw_grid_annotations(im, width, height, hor_texts, ver_texts):
+    text_widths = {}
+
+    def text_width(drawing, text, font):
+        if text not in text_widths:
+            text_widths[text] = drawing.textlength(text, font=font)
+
+        return text_widths[text]
+
+    # prompt matrix labels repeat, once active and once inactive for every combination, so their sizes are cached too
+    text_sizes = {}
+
+    def text_size(drawing, text, font):
+        if text not in text_sizes:
+            bbox = drawing.multiline_textbbox((0, 0), text, font=font)
+            text_sizes[text] = (bbox[2] - bbox[0], bbox[3] - bbox[1])
+
+        return text_sizes[text]
+
     def wrap(drawing, text, font, line_length):
+        # line widths are summed from cached word widths instead of measuring every candidate line
+        space_width = text_width(drawing, ' ', font)
         lines = ['']
+        line_width = 0
         for word in text.split():
-            line = f'{lines[-1]} {word}'.strip()
-            if drawing.textlength(line, font=font) <= line_length:
-                lines[-1] = line
+            word_width = text_width(drawing, word, font)
+            width = line_width + space_width + word_width if lines[-1] else word_width
+            if width <= line_length:
+                lines[-1] = f'{lines[-1]} {word}'.strip()
+                line_width = width
             else:
                 lines.append(word)
+                line_width = word_width
         return lines
 
     def draw_texts(drawing, draw_x, draw_y, lines):
@@ -556,7 +902,7 @@ def draw_grid_annotations(im, width, height, hor_texts, ver_texts):
 
     fontsize = (width + height) // 25
     line_spacing = fontsize // 2
-    fnt = ImageFont.truetype(opts.font, fontsize)
+    fnt = get_font(opts.font, fontsize)
     color_active = (0, 0, 0)
     color_inactive = (153, 153, 153)
 
@@ -580,8 +926,7 @@ def draw_grid_annotations(im, width, height, hor_texts, ver_texts):
             texts += [GridAnnotation(x, line.is_active) for x in wrapped]
 
         for line in texts:
-            bbox = calc_d.multiline_textbbox((0, 0), line.text, font=fnt)
-            line.size = (bbox[2] - bbox[0], bbox[3] - bbox[1])
+            line.size = text_size(calc_d, line.text, fnt)
 
     hor_text_heights = [sum([line.size[1] + line_spacing for line in lines]) - line_spacing for lines in hor_texts]
     ver_text_heights = [sum([line.size[1] + line_spacing for line in lines]) - line_spacing * len(lines) for lines in ver_texts]
@@ -637,6 +982,11 @@ def draw_xy_grid(xs, ys, x_label, y_label, cell):
     return grid
 
 
+def to_rgb(image):
+    """convert() always makes a copy, even when the image already is in the requested mode"""
+    return image if image.mode == "RGB" else image.convert("RGB")
+
+
 def resize_image(resize_mode, im, width, height):
     if resize_mode == 0:
         res = im.resize((width, height), resample=LANCZOS)
@@ -658,17 +1008,21 @@ def resize_image(resize_mode, im, width, height):
         src_h = height if ratio >= src_ratio else im.height * width // im.width
 
         resized = im.resize((src_w, src_h), resample=LANCZOS)
-        res = Image.new("RGB", (width, height))
-        res.paste(resized, box=(width // 2 - src_w // 2, height // 2 - src_h // 2))
 
+        left, top = width // 2 - src_w // 2, height // 2 - src_h // 2
+        pixels = np.zeros((height, width, 3), dtype=np.uint8)
+        pixels[top:top + src_h, left:left + src_w] = np.asarray(to_rgb(resized))
+
+        # the fill is the edge of the image stretched from a zero sized box, which comes out the same for every
+        # row (or column) of the fill, so a single one is resized and then repeated across it
         if ratio < src_ratio:
-            fill_height = height // 2 - src_h // 2
-            res.paste(resized.resize((width, fill_height), box=(0, 0, width, 0)), box=(0, 0))
-            res.paste(resized.resize((width, fill_height), box=(0, resized.height, width, resized.height)), box=(0, fill_height + src_h))
+            pixels[0:top] = np.asarray(to_rgb(resized.resize((width, 1), box=(0, 0, width, 0))))
+            pixels[top + src_h:top * 2 + src_h] = np.asarray(to_rgb(resized.resize((width, 1), box=(0, resized.height, width, resized.height))))
         elif ratio > src_ratio:
-            fill_width = width // 2 - src_w // 2
-            res.paste(resized.resize((fill_width, height), box=(0, 0, 0, height)), box=(0, 0))
-            res.paste(resized.resize((fill_width, height), box=(resized.width, 0, resized.width, height)), box=(fill_width + src_w, 0))
+            pixels[:, 0:left] = np.asarray(to_rgb(resized.resize((1, height), box=(0, 0, 0, height))))
+            pixels[:, left + src_w:left * 2 + src_w] = np.asarray(to_rgb(resized.resize((1, height), box=(resized.width, 0, resized.width, height))))
+
+        res = Image.fromarray(pixels)
 
     return res
 
@@ -676,7 +1030,14 @@ def resize_image(resize_mode, im, width, height):
 def wrap_gradio_gpu_call(func):
     def f(*args, **kwargs):
         with queue_lock:
-            res = func(*args, **kwargs)
+            try:
+                res = func(*args, **kwargs)
+            except RuntimeError as e:
+                # torch keeps freed GPU memory cached for reuse between generations; only hand it back
+                # to the driver when a request has actually run out of it
+                if 'out of memory' in str(e):
+                    torch_gc()
+                raise
 
         return res
 
@@ -712,6 +1073,8 @@ class StableDiffusionModelHijack:
     ids_lookup = {}
     word_embeddings = {}
     word_embeddings_checksums = {}
+    word_embeddings_ids = {}
+    word_embeddings_table = None
     fixes = None
     comments = []
     dir_mtime = None
@@ -724,14 +1087,12 @@ class StableDiffusionModelHijack:
         self.dir_mtime = mt
         self.ids_lookup.clear()
         self.word_embeddings.clear()
+        self.word_embeddings_ids = {}
 
         tokenizer = model.cond_stage_model.tokenizer
 
         def const_hash(a):
-            r = 0
-            for v in a:
-                r = (r * 281 ^ int(v) * 997) & 0xFFFFFFFF
-            return r
+            return zlib.crc32(a.detach().cpu().numpy().tobytes())
 
         def process_file(path, filename):
             name = os.path.splitext(filename)[0]
@@ -743,14 +1104,17 @@ class StableDiffusionModelHijack:
             assert len(param_dict) == 1, 'embedding file has multiple terms in it'
             emb = next(iter(param_dict.items()))[1].reshape(768)
             self.word_embeddings[name] = emb
+            word_id = self.word_embeddings_ids.setdefault(name, len(self.word_embeddings_ids))
             self.word_embeddings_checksums[name] = f'{const_hash(emb) & 0xffff:04x}'
 
             ids = tokenizer([name], add_special_tokens=False)['input_ids'][0]
 
-            first_id = ids[0]
-            if first_id not in self.ids_lookup:
-                self.ids_lookup[first_id] = []
-            self.ids_lookup[first_id].append((ids, name))
+            # ids_lookup is a trie of token ids; a node that ends an embedding's name has it, along with its length
+            # in tokens and its row in word_embeddings_table, under '__end__'
+            node = self.ids_lookup
+            for ident in ids:
+                node = node.setdefault(ident, {})
+            node['__end__'] = (name, len(ids), word_id)
 
         for fn in os.listdir(dirname):
             try:
@@ -760,6 +1124,9 @@ class StableDiffusionModelHijack:
                 print(traceback.format_exc(), file=sys.stderr)
                 continue
 
+        # all embeddings stacked into one tensor on the device, so that the fixes for a whole batch are gathered from it with one index
+        self.word_embeddings_table = torch.stack([self.word_embeddings[name].to(device) for name in self.word_embeddings_ids]) if self.word_embeddings_ids else None
+
         print(f"Loaded a total of {len(self.word_embeddings)} text inversion embeddings.")
 
     def hijack(self, m):
@@ -777,108 +1144,142 @@ class FrozenCLIPEmbedderWithCustomWords(torch.nn.Module):
         self.tokenizer = wrapped.tokenizer
         self.max_length = wrapped.max_length
         self.token_mults = {}
+        self.prompt_cache = {}
+        self.id_start = self.tokenizer.bos_token_id
+        self.id_end = self.tokenizer.eos_token_id
 
-        tokens_with_parens = [(k, v) for k, v in self.tokenizer.get_vocab().items() if '(' in k or ')' in k or '[' in k or ']' in k]
-        for text, ident in tokens_with_parens:
-            mult = 1.0
-            for c in text:
-                if c == '[':
-                    mult /= 1.1
-                if c == ']':
-                    mult *= 1.1
-                if c == '(':
-                    mult *= 1.1
-                if c == ')':
-                    mult /= 1.1
-
-            if mult != 1.0:
-                self.token_mults[ident] = mult
-
-    def forward(self, text):
-        self.hijack.fixes = []
-        self.hijack.comments = []
-        remade_batch_tokens = []
-        id_start = self.wrapped.tokenizer.bos_token_id
-        id_end = self.wrapped.tokenizer.eos_token_id
-        maxlen = self.wrapped.max_length - 2
+        brackets = frozenset('()[]')
+        for text, ident in self.tokenizer.get_vocab().items():
+            if brackets.isdisjoint(text):
+                continue
+
+            power = text.count('(') + text.count(']') - text.count(')') - text.count('[')
+            if power != 0:
+                self.token_mults[ident] = 1.1 ** power
+
+    def remake_tokens(self, tokens):
+        """replace embedding names in a prompt's tokens, apply emphasis and pad to the text encoder's length;
+        returns tokens, embedding fixes, multipliers, a warning if the prompt was truncated, and custom terms used
+        """
+        id_start, id_end = self.id_start, self.id_end
+        maxlen = self.max_length - 2
+
+        fixes = []
+        remade_tokens = []
+        multipliers = []
         used_custom_terms = []
+        mult = 1.0
+
+        i = 0
+        while i < len(tokens):
+            token = tokens[i]
 
-        cache = {}
-        batch_tokens = self.wrapped.tokenizer(text, truncation=False, add_special_tokens=False)["input_ids"]
-        batch_multipliers = []
-        for tokens in batch_tokens:
-            tuple_tokens = tuple(tokens)
+            node = self.hijack.ids_lookup.get(token, None)
 
-            if tuple_tokens in cache:
-                remade_tokens, fixes, multipliers = cache[tuple_tokens]
+            mult_change = self.token_mults.get(token) if opts.enable_emphasis else None
+            if mult_change is not None:
+                mult *= mult_change
+            elif node is None:
+                remade_tokens.append(token)
+                multipliers.append(mult)
             else:
-                fixes = []
-                remade_tokens = []
-                multipliers = []
-                mult = 1.0
-
-                i = 0
-                while i < len(tokens):
-                    token = tokens[i]
-
-                    possible_matches = self.hijack.ids_lookup.get(token, None)
-
-                    mult_change = self.token_mults.get(token) if opts.enable_emphasis else None
-                    if mult_change is not None:
-                        mult *= mult_change
-                    elif possible_matches is None:
-                        remade_tokens.append(token)
-                        multipliers.append(mult)
-                    else:
-                        found = False
-                        for ids, word in possible_matches:
-                            if tokens[i:i + len(ids)] == ids:
-                                fixes.append((len(remade_tokens), word))
-                                remade_tokens.append(777)
-                                multipliers.append(mult)
-                                i += len(ids) - 1
-                                found = True
-                                used_custom_terms.append((word, self.hijack.word_embeddings_checksums[word]))
-                                break
-
-                        if not found:
-                            remade_tokens.append(token)
-                            multipliers.append(mult)
-
-                    i += 1
-
-                if len(remade_tokens) > maxlen - 2:
-                    vocab = {v: k for k, v in self.wrapped.tokenizer.get_vocab().items()}
-                    ovf = remade_tokens[maxlen - 2:]
-                    overflowing_words = [vocab.get(int(x), "") for x in ovf]
-                    overflowing_text = self.wrapped.tokenizer.convert_tokens_to_string(''.join(overflowing_words))
-
-                    self.hijack.comments.append(f"Warning: too many input tokens; some ({len(overflowing_words)}) have been truncated:\n{overflowing_text}\n")
-
-                remade_tokens = remade_tokens + [id_end] * (maxlen - 2 - len(remade_tokens))
-                remade_tokens = [id_start] + remade_tokens[0:maxlen - 2] + [id_end]
-                cache[tuple_tokens] = (remade_tokens, fixes, multipliers)
-
-            multipliers = multipliers + [1.0] * (maxlen - 2 - len(multipliers))
-            multipliers = [1.0] + multipliers[0:maxlen - 2] + [1.0]
-
-            remade_batch_tokens.append(remade_tokens)
+                # walk the trie as far as the prompt allows and take the longest embedding name that matched
+                match = node.get('__end__')
+                j = i + 1
+                while j < len(tokens) and tokens[j] in node:
+                    node = node[tokens[j]]
+                    match = node.get('__end__', match)
+                    j += 1
+
+                if match is None:
+                    remade_tokens.append(token)
+                    multipliers.append(mult)
+                else:
+                    word, length, word_id = match
+                    fixes.append((len(remade_tokens), word_id))
+                    remade_tokens.append(777)
+                    multipliers.append(mult)
+                    i += length - 1
+                    used_custom_terms.append((word, self.hijack.word_embeddings_checksums[word]))
+
+            i += 1
+
+        comment = None
+        if len(remade_tokens) > maxlen - 2:
+            ovf = remade_tokens[maxlen - 2:]
+            overflowing_words = self.wrapped.tokenizer.convert_ids_to_tokens([int(x) for x in ovf])
+            overflowing_text = self.wrapped.tokenizer.convert_tokens_to_string(''.join(overflowing_words))
+
+            comment = f"Warning: too many input tokens; some ({len(overflowing_words)}) have been truncated:\n{overflowing_text}\n"
+
+        # start and end tokens are added and the rest padded in place, in lists allocated once at their final length
+        count = min(len(remade_tokens), maxlen - 2)
+        padded_tokens = [id_end] * maxlen
+        padded_tokens[0] = id_start
+        padded_tokens[1:1 + count] = remade_tokens[:count]
+
+        padded_multipliers = [1.0] * maxlen
+        padded_multipliers[1:1 + count] = multipliers[:count]
+
+        return padded_tokens, fixes, padded_multipliers, comment, used_custom_terms
+
+    def forward(self, text, mean_groups=1):
+        """encode a batch of prompts; with mean_groups > 1 the batch is treated as that many equally sized groups of
+        prompts (e.g. negative and positive ones), and the mean is restored for each group on its own
+        """
+        self.hijack.fixes = []
+        self.hijack.comments = []
+        used_custom_terms = []
+
+        # the same prompts are encoded over and over, for every batch and every generation, so their tokens are kept;
+        # the result depends on the emphasis setting and on which embeddings are loaded as well
+        keys = [(line, opts.enable_emphasis, self.hijack.dir_mtime) for line in text]
+        remade = {key: self.prompt_cache.get(key) for key in keys}
+        missing = [key for key, item in remade.items() if item is None]
+        if missing:
+            batch_tokens = self.wrapped.tokenizer([key[0] for key in missing], truncation=False, add_special_tokens=False)["input_ids"]
+            for key, tokens in zip(missing, batch_tokens):
+                remade[key] = self.remake_tokens(tokens)
+
+                if len(self.prompt_cache) >= 512:
+                    del self.prompt_cache[next(iter(self.prompt_cache))]
+                self.prompt_cache[key] = remade[key]
+
+        for remade_tokens, fixes, multipliers, comment, custom_terms in remade.values():
+            if comment is not None:
+                self.hijack.comments.append(comment)
+            used_custom_terms += custom_terms
+
+        # the batch is written straight into the tensors that get copied to the device, pinned if that device is a GPU
+        length = len(remade[keys[0]][0])
+        pin = device.type == 'cuda'
+        tokens = torch.empty((len(keys), length), dtype=torch.int64, pin_memory=pin)
+        batch_multipliers = torch.empty((len(keys), length), dtype=torch.float32, pin_memory=pin)
+        tokens_array, multipliers_array = tokens.numpy(), batch_multipliers.numpy()
+        for i, key in enumerate(keys):
+            remade_tokens, fixes, multipliers, comment, custom_terms = remade[key]
+
+            tokens_array[i] = remade_tokens
+            multipliers_array[i] = multipliers
             self.hijack.fixes.append(fixes)
-            batch_multipliers.append(multipliers)
 
         if len(used_custom_terms) > 0:
             self.hijack.comments.append("Used custom terms: " + ", ".join([f'{word} [{checksum}]' for word, checksum in used_custom_terms]))
 
-        tokens = torch.asarray(remade_batch_tokens).to(device)
+        # both copies are queued before the transformer runs so the multipliers arrive while it computes
+        tokens = tokens.to(device, non_blocking=True)
+        batch_multipliers = batch_multipliers.to(device, non_blocking=True)
+
         outputs = self.wrapped.transformer(input_ids=tokens)
         z = outputs.last_hidden_state
 
         # restoring original mean is likely not correct, but it seems to work well to prevent artifacts that happen otherwise
-        batch_multipliers = torch.asarray(np.array(batch_multipliers)).to(device)
-        original_mean = z.mean()
-        z *= batch_multipliers.reshape(batch_multipliers.shape + (1,)).expand(z.shape)
-        new_mean = z.mean()
-        z *= original_mean / new_mean
+        # both means come from one pass over z: the mean after weighting is the multiplier-weighted sum of per-token sums,
+        # and z is then scaled once by the multipliers and the mean correction together
+        token_sums = z.sum(dim=2, dtype=torch.float32).reshape((mean_groups, -1))
+        multipliers = batch_multipliers.to(torch.float32).reshape((mean_groups, -1))
+        mean_correction = token_sums.sum(dim=1, keepdim=True) / (token_sums * multipliers).sum(dim=1, keepdim=True)
+        z *= (multipliers * mean_correction).to(z.dtype).reshape(batch_multipliers.shape).unsqueeze(-1)
 
         return z
 
@@ -895,10 +1296,19 @@ class EmbeddingsWithFixes(nn.Module):
 
         inputs_embeds = self.wrapped(input_ids)
 
-        if batch_fixes is not None:
-            for fixes, tensor in zip(batch_fixes, inputs_embeds):
-                for offset, word in fixes:
-                    tensor[offset] = self.embeddings.word_embeddings[word]
+        if batch_fixes is not None and any(batch_fixes):
+            # write all custom word embeddings with a single indexed assignment rather than one small copy per word
+            batch_indices = [b for b, fixes in enumerate(batch_fixes) for _ in fixes]
+            offsets = [offset for fixes in batch_fixes for offset, _ in fixes]
+            word_ids = [word_id for fixes in batch_fixes for _, word_id in fixes]
+
+            # the table is converted to the text encoder's device and precision once and kept that way
+            table = self.embeddings.word_embeddings_table
+            if table.device != inputs_embeds.device or table.dtype != inputs_embeds.dtype:
+                table = self.embeddings.word_embeddings_table = table.to(device=inputs_embeds.device, dtype=inputs_embeds.dtype)
+
+            index = torch.tensor([batch_indices, offsets, word_ids], device=inputs_embeds.device)
+            inputs_embeds.index_put_((index[0], index[1]), table[index[2]])
 
         return inputs_embeds
 
@@ -924,18 +1334,28 @@ class StableDiffusionProcessing:
         self.extra_generation_params: dict = extra_generation_params
         self.overlay_images = overlay_images
         self.paste_to = None
+        self.conditioning_cache = None
 
     def init(self):
         pass
 
+    def init_batch(self, n):
+        pass
+
     def sample(self, x, conditioning, unconditional_conditioning):
         raise NotImplementedError()
 
 
+def blend_latents(init_latent, x, nmask):
+    """init_latent where nmask is 0 and x where it is 1, as one lerp kernel rather than two multiplies and an add"""
+    dtype = torch.promote_types(torch.promote_types(init_latent.dtype, x.dtype), nmask.dtype)
+    return torch.lerp(init_latent.to(dtype), x.to(dtype), nmask.to(dtype))
+
+
 def p_sample_ddim_hook(sampler_wrapper, x_dec, cond, ts, *args, **kwargs):
-    if sampler_wrapper.mask is not None:
+    if sampler_wrapper.nmask is not None:
         img_orig = sampler_wrapper.sampler.model.q_sample(sampler_wrapper.init_latent, ts)
-        x_dec = img_orig * sampler_wrapper.mask + sampler_wrapper.nmask * x_dec
+        x_dec = blend_latents(img_orig, x_dec, sampler_wrapper.nmask)
 
     return sampler_wrapper.orig_p_sample_ddim(x_dec, cond, ts, *args, **kwargs)
 
@@ -944,7 +1364,6 @@ class VanillaStableDiffusionSampler:
     def __init__(self, constructor):
         self.sampler = constructor(sd_model)
         self.orig_p_sample_ddim = self.sampler.p_sample_ddim if hasattr(self.sampler, 'p_sample_ddim') else None
-        self.mask = None
         self.nmask = None
         self.init_latent = None
 
@@ -960,7 +1379,6 @@ class VanillaStableDiffusionSampler:
         x1 = self.sampler.stochastic_encode(x, torch.tensor([t_enc] * int(x.shape[0])).to(device), noise=noise)
 
         self.sampler.p_sample_ddim = lambda x_dec, cond, ts, *args, **kwargs: p_sample_ddim_hook(self, x_dec, cond, ts, *args, **kwargs)
-        self.mask = p.mask
         self.nmask = p.nmask
         self.init_latent = p.init_latent
 
@@ -970,6 +1388,9 @@ class VanillaStableDiffusionSampler:
 
 
     def sample(self, p: StableDiffusionProcessing, x, conditioning, unconditional_conditioning):
+        # the sampler may be reused after an img2img run, which would have left its mask set
+        self.nmask = None
+
         samples_ddim, _ = self.sampler.sample(S=p.steps, conditioning=conditioning, batch_size=int(x.shape[0]), shape=x[0].shape, verbose=False, unconditional_guidance_scale=p.cfg_scale, unconditional_conditioning=unconditional_conditioning, x_T=x)
         return samples_ddim
 
@@ -978,24 +1399,45 @@ class CFGDenoiser(nn.Module):
     def __init__(self, model):
         super().__init__()
         self.inner_model = model
-        self.mask = None
         self.nmask = None
         self.init_latent = None
+        self.x_in = None
+        self.sigma_in = None
+        self.cond_in = None
+        self.cond_in_sources = (None, None)
+
+    @staticmethod
+    def doubled(buffer, t):
+        """write two copies of t into buffer, reallocating it only if the shape changed since the previous step"""
+        shape = (t.shape[0] * 2,) + tuple(t.shape[1:])
+        if buffer is None or buffer.shape != shape or buffer.dtype != t.dtype or buffer.device != t.device:
+            buffer = torch.empty(shape, dtype=t.dtype, device=t.device)
+
+        buffer[:t.shape[0]].copy_(t)
+        buffer[t.shape[0]:].copy_(t)
+        return buffer
 
     def forward(self, x, sigma, uncond, cond, cond_scale):
         if batch_cond_uncond:
-            x_in = torch.cat([x] * 2)
-            sigma_in = torch.cat([sigma] * 2)
-            cond_in = torch.cat([uncond, cond])
-            uncond, cond = self.inner_model(x_in, sigma_in, cond=cond_in).chunk(2)
-            denoised = uncond + (cond - uncond) * cond_scale
+            self.x_in = self.doubled(self.x_in, x)
+            self.sigma_in = self.doubled(self.sigma_in, sigma)
+
+            # samplers pass the same conditioning tensors on every step, so they only need to be joined once
+            if self.cond_in_sources[0] is not uncond or self.cond_in_sources[1] is not cond:
+                self.cond_in = torch.cat([uncond, cond])
+                self.cond_in_sources = (uncond, cond)
+
+            uncond, cond = self.inner_model(self.x_in, self.sigma_in, cond=self.cond_in).chunk(2)
+
+            # same arithmetic as uncond + (cond - uncond) * cond_scale, done in place in the model's output
+            denoised = cond.sub_(uncond).mul_(cond_scale).add_(uncond)
         else:
             uncond = self.inner_model(x, sigma, cond=uncond)
             cond = self.inner_model(x, sigma, cond=cond)
             denoised = uncond + (cond - uncond) * cond_scale
 
-        if self.mask is not None:
-            denoised = self.init_latent * self.mask + self.nmask * denoised
+        if self.nmask is not None:
+            denoised = blend_latents(self.init_latent, denoised, self.nmask)
 
         return denoised
 
@@ -1024,7 +1466,6 @@ class KDiffusionSampler:
 
         sigma_sched = sigmas[p.steps - t_enc - 1:]
 
-        self.model_wrap_cfg.mask = p.mask
         self.model_wrap_cfg.nmask = p.nmask
         self.model_wrap_cfg.init_latent = p.init_latent
 
@@ -1034,6 +1475,9 @@ class KDiffusionSampler:
         return self.func(self.model_wrap_cfg, xi, sigma_sched, extra_args={'cond': conditioning, 'uncond': unconditional_conditioning, 'cond_scale': p.cfg_scale}, disable=False)
 
     def sample(self, p: StableDiffusionProcessing, x, conditioning, unconditional_conditioning):
+        # the sampler may be reused after an img2img run, which would have left its mask set
+        self.model_wrap_cfg.nmask = None
+
         sigmas = self.model_wrap.get_sigmas(p.steps)
         x = x * sigmas[0]
 
@@ -1104,7 +1548,6 @@ def process_images(p: StableDiffusionProcessing) -> Processed:
     model = sd_model
 
     assert p.prompt is not None
-    torch_gc()
 
     seed = int(random.randrange(4294967294) if p.seed == -1 else p.seed)
 
@@ -1115,18 +1558,19 @@ def process_images(p: StableDiffusionProcessing) -> Processed:
 
     prompt_matrix_parts = []
     if p.prompt_matrix:
-        all_prompts = []
         prompt_matrix_parts = prompt.split("|")
-        combination_count = 2 ** (len(prompt_matrix_parts) - 1)
-        for combination_num in range(combination_count):
-            selected_prompts = [text.strip().strip(',') for n, text in enumerate(prompt_matrix_parts[1:]) if combination_num & (1 << n)]
-
-            if opts.prompt_matrix_add_to_start:
-                selected_prompts = selected_prompts + [prompt_matrix_parts[0]]
-            else:
-                selected_prompts = [prompt_matrix_parts[0]] + selected_prompts
-
-            all_prompts.append(", ".join(selected_prompts))
+        base_prompt = prompt_matrix_parts[0]
+        variable_parts = [text.strip().strip(',') for text in prompt_matrix_parts[1:]]
+
+        # combination number's bits select variable parts; grid layout in draw_prompt_matrix depends on this order.
+        # each part doubles the list, adding itself to every earlier combination, so no combination is filtered twice
+        combinations = [[]]
+        for text in variable_parts:
+            combinations += [selected_prompts + [text] for selected_prompts in combinations]
+        if opts.prompt_matrix_add_to_start:
+            all_prompts = [", ".join(selected_prompts + [base_prompt]) for selected_prompts in combinations]
+        else:
+            all_prompts = [", ".join([base_prompt] + selected_prompts) for selected_prompts in combinations]
 
         p.n_iter = math.ceil(len(all_prompts) / p.batch_size)
         all_seeds = len(all_prompts) * [seed]
@@ -1147,58 +1591,59 @@ def process_images(p: StableDiffusionProcessing) -> Processed:
     if p.extra_generation_params is not None:
         generation_params.update(p.extra_generation_params)
 
-    generation_params_text = ", ".join([k if k == v else f'{k}: {v}' for k, v in generation_params.items() if v is not None])
+    generation_params_text = ", ".join(k if k == v else f'{k}: {v}' for k, v in generation_params.items() if v is not None)
+
+    # comments are only ever appended to, so their count tells whether the cached info is still current
+    infotexts = {}
 
     def infotext():
-        return OutputInfo(prompt, generation_params_text, "".join(["\n\n" + x for x in comments]))
+        if len(comments) not in infotexts:
+            infotexts[len(comments)] = OutputInfo(prompt, generation_params_text, "".join("\n\n" + x for x in comments))
+
+        return infotexts[len(comments)]
 
     if os.path.exists(cmd_opts.embeddings_dir):
         model_hijack.load_textual_inversion_embeddings(cmd_opts.embeddings_dir, model)
 
-    output_images = []
+    saves = []
     precision_scope = autocast if cmd_opts.precision == "autocast" else nullcontext
     ema_scope = (nullcontext if cmd_opts.lowvram else model.ema_scope)
-    with torch.no_grad(), precision_scope("cuda"), ema_scope():
+    # low VRAM modes move modules between devices in the middle of a generation, which inference mode does not allow
+    grad_scope = (torch.no_grad if cmd_opts.lowvram or cmd_opts.medvram else torch.inference_mode)
+    with grad_scope(), precision_scope("cuda"), ema_scope():
         p.init()
 
-        for n in range(p.n_iter):
-            if state.interrupted:
-                break
+        # constructing GFPGANer loads its weights, so it is done once per generation rather than once per image
+        gfpgan_model = gfpgan() if p.use_GFPGAN else None
 
-            prompts = all_prompts[n * p.batch_size:(n + 1) * p.batch_size]
-            seeds = all_seeds[n * p.batch_size:(n + 1) * p.batch_size]
+        # samplers don't modify their input noise in place, so one buffer is refilled for every batch
+        noise = torch.empty((p.batch_size, opt_C, p.height // opt_f, p.width // opt_f), device=device)
 
-            uc = model.get_learned_conditioning(len(prompts) * [p.negative_prompt])
-            c = model.get_learned_conditioning(prompts)
+        # one slot per image that can be generated; an interrupted run leaves the tail unused
+        output_images = [None] * (p.n_iter * p.batch_size)
+        batches = []
 
-            if len(model_hijack.comments) > 0:
-                comments += model_hijack.comments
+        # the grid is filled in as images come out of the save thread; for runs where images end up with a different
+        # size or the count isn't known up front, it is put together with image_grid afterwards
+        grid_count = min(len(all_prompts), len(output_images))
+        grid_rows = (1 << ((len(prompt_matrix_parts) - 1) // 2)) if p.prompt_matrix else image_grid_rows(grid_count, p.batch_size)
+        grid_cols = math.ceil(grid_count / grid_rows)
+        grid_canvas = None
+        if not p.do_not_save_grid and p.paste_to is None and not (grid_count < 2 and opts.grid_only_if_multiple):
+            grid_canvas = np.zeros((grid_rows * p.height, grid_cols * p.width, 3), dtype=np.uint8)
 
-            # we manually generate all input noises because each one should have a specific seed
-            x = create_random_tensors([opt_C, p.height // opt_f, p.width // opt_f], seeds=seeds)
+        def finish_batch(offset, x_samples, copied, prompts, seeds, info):
+            nonlocal grid_canvas
 
-            if p.n_iter > 1:
-                state.job = f"Batch {n+1} out of {p.n_iter}"
+            if copied is not None:
+                copied.synchronize()
 
-            samples_ddim = p.sample(x=x, conditioning=c, unconditional_conditioning=uc)
-
-            x_samples_ddim = model.decode_first_stage(samples_ddim)
-            x_samples_ddim = torch.clamp((x_samples_ddim + 1.0) / 2.0, min=0.0, max=1.0)
-
-            for i, x_sample in enumerate(x_samples_ddim):
-                x_sample = 255. * np.moveaxis(x_sample.cpu().numpy(), 0, 2)
-                x_sample = x_sample.astype(np.uint8)
-
-                if p.use_GFPGAN:
-                    torch_gc()
+            for i, x_sample in enumerate(x_samples):
+                image = Image.fromarray(np.asarray(x_sample))
 
-                    gfpgan_model = gfpgan()
-                    x_sample = gfpgan_fix_faces(gfpgan_model, x_sample)
-
-                image = Image.fromarray(x_sample)
-
-                if p.overlay_images is not None and i < len(p.overlay_images):
-                    overlay = p.overlay_images[i]
+                # overlays line up with the init images, which batches take from the same position (see init_batch)
+                if p.overlay_images:
+                    overlay = p.overlay_images[(offset + i) % len(p.overlay_images)]
 
                     if p.paste_to is not None:
                         x, y, w, h = p.paste_to
@@ -1212,35 +1657,105 @@ def process_images(p: StableDiffusionProcessing) -> Processed:
                     image = image.convert('RGB')
 
                 if opts.samples_save and not p.do_not_save_samples:
-                    save_image(image, p.outpath_samples, "", seeds[i], prompts[i], opts.samples_format, info=str(infotext()))
+                    save_image(image, p.outpath_samples, "", seeds[i], prompts[i], opts.samples_format, info=info)
+
+                output_images[offset + i] = image
 
-                output_images.append(image)
+                if grid_canvas is not None and image.size != (p.width, p.height):
+                    grid_canvas = None
 
-        unwanted_grid_because_of_img_count = len(output_images) < 2 and opts.grid_only_if_multiple
-        if not p.do_not_save_grid and not unwanted_grid_because_of_img_count:
-            return_grid = opts.return_grid
+                if grid_canvas is not None and offset + i < grid_count:
+                    y, x = (offset + i) // grid_cols * p.height, (offset + i) % grid_cols * p.width
+                    grid_canvas[y:y + p.height, x:x + p.width] = np.asarray(image)
 
-            if p.prompt_matrix:
-                grid = image_grid(output_images, p.batch_size, rows=1 << ((len(prompt_matrix_parts) - 1) // 2))
+            return len(x_samples)
 
-                try:
-                    grid = draw_prompt_matrix(grid, p.width, p.height, prompt_matrix_parts)
-                except Exception:
-                    import traceback
-                    print("Error creating prompt_matrix text:", file=sys.stderr)
-                    print(traceback.format_exc(), file=sys.stderr)
+        for n in range(p.n_iter):
+            if state.interrupted:
+                break
 
-                return_grid = True
+            prompts = all_prompts[n * p.batch_size:(n + 1) * p.batch_size]
+            seeds = all_seeds[n * p.batch_size:(n + 1) * p.batch_size]
+
+            # a batch with the same prompts as the previous one, which is the usual case with several batches and in
+            # loopback, where p is reused between runs, gets the same conditioning without running the text encoder again
+            conditioning_key = (tuple(prompts), p.negative_prompt, opts.enable_emphasis, model_hijack.dir_mtime)
+            if p.conditioning_cache is None or p.conditioning_cache[0] != conditioning_key:
+                # negative and positive prompts share one text encoder pass; this is what get_learned_conditioning does
+                # for the CLIP embedder, with mean restoration kept separate for the two halves
+                uc, c = model.cond_stage_model(len(prompts) * [p.negative_prompt] + prompts, mean_groups=2).chunk(2)
+                p.conditioning_cache = (conditioning_key, uc, c, list(model_hijack.comments))
+
+            _, uc, c, conditioning_comments = p.conditioning_cache
+
+            if len(conditioning_comments) > 0:
+                comments += conditioning_comments
+
+            # the batch's init latent is set up before the noise, because the latent noise inpainting fill seeds the global
+            # RNG too; the sample noise has to be drawn last, so ancestral samplers continue from the same state as before
+            p.init_batch(n)
+
+            # we manually generate all input noises because each one should have a specific seed
+            x = create_random_tensors(noise.shape[1:], seeds=seeds, out=noise)
+
+            if p.n_iter > 1:
+                state.job = f"Batch {n+1} out of {p.n_iter}"
+
+            samples_ddim = p.sample(x=x, conditioning=c, unconditional_conditioning=uc)
+
+            x_samples_ddim = decode_first_stage(model, samples_ddim)
+
+            # map [-1, 1] to [0, 255] in place, in whatever precision the decoder produced (fp16 unless running in full precision),
+            # and convert the whole batch to HWC uint8 on the GPU, so only a quarter of the data has to come back to the CPU;
+            # the precision must stay the decoder's: the original clamp((x + 1) / 2) * 255 ran in it too (numpy keeps fp16
+            # when multiplying by a python float), and halving is exact, so * 127.5 rounds to the same values; scaling in
+            # float32 instead would move pixels that land just below an integer by one level
+            x_samples_ddim = x_samples_ddim.add_(1.0).mul_(127.5).clamp_(min=0.0, max=255.0)
+            x_samples_ddim = x_samples_ddim.to(torch.uint8).permute(0, 2, 3, 1)
+
+            if gfpgan_model is not None:
+                # GFPGAN wants BGR; reversing the channels on the GPU hands it contiguous arrays with no extra pass on the CPU
+                x_samples_ddim = [gfpgan_fix_faces(gfpgan_model, x_sample, is_bgr=True) for x_sample in x_samples_ddim.flip(3).cpu().numpy()]
+                copied = None
             else:
-                grid = image_grid(output_images, p.batch_size)
+                x_samples_ddim, copied = to_host_non_blocking(x_samples_ddim)
 
-            if return_grid:
-                output_images.insert(0, grid)
+            # the rest of the work on this batch is done on the CPU by the save thread while the next batch is sampled
+            batches.append(save_image_executor.submit(finish_batch, n * p.batch_size, x_samples_ddim, copied, prompts, seeds, str(infotext())))
 
-            if opts.grid_save:
-                save_image(grid, p.outpath_grids, "grid", seed, prompt, opts.grid_format, info=str(infotext()), short_filename=not opts.grid_extended_filename)
+    # the rest is CPU work on finished images, which doesn't need to run under autocast and the other model scopes
+    output_count = sum(batch.result() for batch in batches)
+    del output_images[output_count:]
+
+    unwanted_grid_because_of_img_count = len(output_images) < 2 and opts.grid_only_if_multiple
+    if not p.do_not_save_grid and not unwanted_grid_because_of_img_count:
+        return_grid = opts.return_grid
+
+        if grid_canvas is not None and len(output_images) == grid_count:
+            grid = Image.fromarray(grid_canvas)
+        else:
+            grid = image_grid(output_images, p.batch_size, rows=grid_rows if p.prompt_matrix else None)
+
+        if p.prompt_matrix:
+            try:
+                grid = draw_prompt_matrix(grid, p.width, p.height, prompt_matrix_parts)
+            except Exception:
+                import traceback
+                print("Error creating prompt_matrix text:", file=sys.stderr)
+                print(traceback.format_exc(), file=sys.stderr)
+
+            return_grid = True
+
+        if return_grid:
+            output_images = [grid] + output_images
+
+        if opts.grid_save:
+            saves.append(save_image_executor.submit(save_image, grid, p.outpath_grids, "grid", seed, prompt, opts.grid_format, info=str(infotext()), short_filename=not opts.grid_extended_filename))
+
+    # wait for pending saves so that errors from them are reported for this request
+    for save in saves:
+        save.result()
 
-    torch_gc()
     return Processed(p, output_images, seed, infotext())
 
 
@@ -1248,7 +1763,7 @@ class StableDiffusionProcessingTxt2Img(StableDiffusionProcessing):
     sampler = None
 
     def init(self):
-        self.sampler = samplers[self.sampler_index].constructor()
+        self.sampler = create_sampler(samplers[self.sampler_index])
 
     def sample(self, x, conditioning, unconditional_conditioning):
         samples_ddim = self.sampler.sample(self, x, conditioning, unconditional_conditioning)
@@ -1343,30 +1858,24 @@ def save_files(images, json_params):
 def get_crop_region(mask, pad=0):
     h, w = mask.shape
 
-    crop_left = 0
-    for i in range(w):
-        if not (mask[:,i] == 0).all():
-            break
-        crop_left += 1
-
-    crop_right = 0
-    for i in reversed(range(w)):
-        if not (mask[:,i] == 0).all():
-            break
-        crop_right += 1
-
-
-    crop_top = 0
-    for i in range(h):
-        if not (mask[i] == 0).all():
-            break
-        crop_top += 1
-
-    crop_bottom = 0
-    for i in reversed(range(h)):
-        if not (mask[i] == 0).all():
-            break
-        crop_bottom += 1
+    # which columns and rows have any part of the mask in them; the crop is the distance to the first of them from each side
+    if mask.dtype == np.uint8 and w % 8 == 0 and mask.flags.c_contiguous:
+        # eight pixels at a time: OR-ing rows of 64 bit words together and viewing the result as bytes again tells for
+        # every column whether it has anything in it, without a boolean copy of the whole mask
+        packed = mask.view(np.uint64)
+        cols = np.bitwise_or.reduce(packed, axis=0).view(np.uint8) != 0
+        rows = packed.any(axis=1)
+    else:
+        cols = (mask != 0).any(axis=0)
+        rows = (mask != 0).any(axis=1)
+
+    if cols.any():
+        crop_left = int(np.argmax(cols))
+        crop_right = int(np.argmax(cols[::-1]))
+        crop_top = int(np.argmax(rows))
+        crop_bottom = int(np.argmax(rows[::-1]))
+    else:
+        crop_left, crop_right, crop_top, crop_bottom = w, w, h, h
 
     return (
         int(max(crop_left-pad, 0)),
@@ -1382,10 +1891,9 @@ def fill(image, mask):
     image_masked = Image.new('RGBa', (image.width, image.height))
     image_masked.paste(image.convert("RGBA").convert("RGBa"), mask=ImageOps.invert(mask.convert('L')))
 
-    image_masked = image_masked.convert('RGBa')
-
     for radius, repeats in [(64, 1), (16, 2), (4, 4), (2, 2), (0, 1)]:
-        blurred = image_masked.filter(ImageFilter.GaussianBlur(radius)).convert('RGBA')
+        # a blur with radius 0 leaves the image as it is, so that pass just uses the masked image itself
+        blurred = (image_masked.filter(ImageFilter.GaussianBlur(radius)) if radius > 0 else image_masked).convert('RGBA')
         for _ in range(repeats):
             image_mod.alpha_composite(blurred)
 
@@ -1407,11 +1915,10 @@ class StableDiffusionProcessingImg2Img(StableDiffusionProcessing):
         self.mask_blur = mask_blur
         self.inpainting_fill = inpainting_fill
         self.inpaint_full_res = inpaint_full_res
-        self.mask = None
         self.nmask = None
 
     def init(self):
-        self.sampler = samplers_for_img2img[self.sampler_index].constructor()
+        self.sampler = create_sampler(samplers_for_img2img[self.sampler_index])
         crop_region = None
 
         if self.image_mask is not None:
@@ -1440,7 +1947,7 @@ class StableDiffusionProcessingImg2Img(StableDiffusionProcessing):
             raise Exception('No input image provided')
 
         for img in self.init_images:
-            image = img.convert("RGB")
+            image = to_rgb(img)
 
             if crop_region is None:
                 image = resize_image(self.resize_mode, image, self.width, self.height)
@@ -1458,49 +1965,67 @@ class StableDiffusionProcessingImg2Img(StableDiffusionProcessing):
                 image = image.crop(crop_region)
                 image = resize_image(2, image, self.width, self.height)
 
-            image = np.array(image).astype(np.float32) / 255.0
-            image = np.moveaxis(image, 2, 0)
-
-            imgs.append(image)
+            imgs.append(np.asarray(image))
 
         if len(imgs) == 1:
-            batch_images = np.expand_dims(imgs[0], axis=0).repeat(self.batch_size, axis=0)
+            batch_images = stack_images_pinned(imgs * self.batch_size)
             if self.overlay_images is not None:
                 self.overlay_images = self.overlay_images * self.batch_size
         elif len(imgs) <= self.batch_size:
             self.batch_size = len(imgs)
-            batch_images = np.array(imgs)
+            batch_images = stack_images_pinned(imgs)
+        elif len(imgs) <= self.batch_size * self.n_iter:
+            # every batch gets its own images; the last one is filled up by repeating the final image
+            padding = self.batch_size * self.n_iter - len(imgs)
+            imgs += imgs[-1:] * padding
+            if self.overlay_images is not None:
+                self.overlay_images += self.overlay_images[-1:] * padding
+            batch_images = stack_images_pinned(imgs)
         else:
-            raise RuntimeError(f"bad number of images passed: {len(imgs)}; expecting {self.batch_size} or less")
+            raise RuntimeError(f"bad number of images passed: {len(imgs)}; expecting {self.batch_size * self.n_iter} or less")
 
-        image = torch.from_numpy(batch_images)
-        image = 2. * image - 1.
-        image = image.to(device)
-
-        self.init_latent = sd_model.get_first_stage_encoding(sd_model.encode_first_stage(image))
+        self.batch_images = batch_images
+        self.batch_images_start = None
+        self.init_latent = None
 
         if self.image_mask is not None:
-            latmask = self.image_mask.convert('RGB').resize((self.init_latent.shape[3], self.init_latent.shape[2]))
-            latmask = np.moveaxis(np.array(latmask, dtype=np.float64), 2, 0) / 255
-            latmask = latmask[0]
-            latmask = np.tile(latmask[None], (4, 1, 1))
+            # only the first channel of the mask is used; it is uploaded as uint8 at latent size and broadcast over the
+            # latent's channels, so there are no float64 or per-channel copies of it on the CPU; the copy is made from pinned
+            # memory so it doesn't stall the stream; only nmask is kept, the weights of the original latent being 1 - nmask
+            latmask = self.image_mask if self.image_mask.mode == 'L' else self.image_mask.convert('RGB').getchannel(0)
+            latmask = latmask.resize((self.width // opt_f, self.height // opt_f))
+            latmask = np.asarray(latmask)
+            host_latmask = torch.empty(latmask.shape, dtype=torch.uint8, pin_memory=device.type == 'cuda')
+            host_latmask.numpy()[:] = latmask
+            latmask = host_latmask.to(device, non_blocking=True).to(torch.float32).div_(255)[None, None]
+
+            self.nmask = latmask.type(sd_model.dtype)
+
+    def init_batch(self, n):
+        start = n * self.batch_size % len(self.batch_images)
+
+        # with a single batch worth of images, every batch starts from the same latent, so it is only encoded once
+        if self.init_latent is not None and start == self.batch_images_start:
+            return
+
+        self.batch_images_start = start
 
-            self.mask = torch.asarray(1.0 - latmask).to(device).type(sd_model.dtype)
-            self.nmask = torch.asarray(latmask).to(device).type(sd_model.dtype)
+        self.init_latent = encode_first_stage(sd_model, self.batch_images[start:start + self.batch_size])
 
-        if self.mask is not None:
+        if self.nmask is not None:
             if self.inpainting_fill == 2:
                 # noise fill initial masked region of initial latent space
-                self.init_latent = self.init_latent * self.mask + create_random_tensors(self.init_latent.shape[1:], [self.seed + x + 1 for x in range(self.init_latent.shape[0])]) * self.nmask
+                noise = create_random_tensors(self.init_latent.shape[1:], [self.seed + x + 1 for x in range(self.init_latent.shape[0])])
+                self.init_latent = blend_latents(self.init_latent, noise, self.nmask)
             elif self.inpainting_fill == 3:
                 # zero fill initial masked region of initial latent space
-                self.init_latent = self.init_latent * self.mask
+                self.init_latent = self.init_latent * (1.0 - self.nmask)
 
     def sample(self, x, conditioning, unconditional_conditioning):
         samples = self.sampler.sample_img2img(self, self.init_latent, x, conditioning, unconditional_conditioning)
 
-        if self.mask is not None:
-            samples = samples * self.nmask + self.init_latent * self.mask
+        if self.nmask is not None:
+            samples = blend_latents(self.init_latent, samples, self.nmask)
 
         return samples
 
@@ -1571,17 +2096,19 @@ def img2img(
         extra_generation_params={"DNS": denoising_strength}
     )
 
+    grid_save = None
+
     if is_loopback:
         output_images, info = None, None
         history = []
         initial_seed = None
         initial_info = None
 
-        for i in range(n_iter):
-            p.n_iter = 1
-            p.batch_size = 1
-            p.do_not_save_grid = True
+        p.n_iter = 1
+        p.batch_size = 1
+        p.do_not_save_grid = True
 
+        for i in range(n_iter):
             state.job = f"Batch {i + 1} out of {n_iter}"
             processed = process_images(p)
 
@@ -1596,7 +2123,7 @@ def img2img(
 
         grid = image_grid(history, batch_size, rows=1)
 
-        save_image(grid, p.outpath_grids, "grid", initial_seed, prompt, opts.grid_format, info=str(info), short_filename=not opts.grid_extended_filename)
+        grid_save = save_image_in_background(grid, p.outpath_grids, "grid", initial_seed, prompt, opts.grid_format, info=str(info), short_filename=not opts.grid_extended_filename)
 
         processed = Processed(p, history, initial_seed, initial_info)
 
@@ -1611,62 +2138,60 @@ def img2img(
 
         grid = split_grid(img, tile_w=width, tile_h=height, overlap=upscale_overlap)
 
-        p.n_iter = 1
         p.do_not_save_grid = True
         p.do_not_save_samples = True
 
-        work = []
-        work_results = []
-
-        for y, h, row in grid.tiles:
-            for tiledata in row:
-                work.append(tiledata[2])
+        tiles = grid.tiles.reshape((-1, grid.tile_h, grid.tile_w, 3))
+        work = [Image.fromarray(tile) for tile in tiles]
 
         batch_count = math.ceil(len(work) / p.batch_size)
-        print(f"SD upscaling will process a total of {len(work)} images tiled as {len(grid.tiles[0][2])}x{len(grid.tiles)} in a total of {batch_count} batches.")
-
-        for i in range(batch_count):
-            p.init_images = work[i * p.batch_size:(i + 1) * p.batch_size]
+        print(f"SD upscaling will process a total of {len(work)} images tiled as {len(grid.xs)}x{len(grid.ys)} in a total of {batch_count} batches.")
 
-            state.job = f"Batch {i + 1} out of {batch_count}"
-            processed = process_images(p)
-
-            if initial_seed is None:
-                initial_seed = processed.seed
-                initial_info = processed.info
+        # all tiles go through a single process_images call, which loops over the batches itself
+        p.init_images = work
+        p.n_iter = batch_count
+        processed = process_images(p)
 
-            p.seed = processed.seed + 1
-            work_results += processed.images
+        initial_seed = processed.seed
+        initial_info = processed.info
+        work_results = processed.images
 
-        image_index = 0
-        for y, h, row in grid.tiles:
-            for tiledata in row:
-                tiledata[2] = work_results[image_index] if image_index<len(work_results) else Image.new("RGB", (p.width, p.height))
-                image_index += 1
+        for image_index in range(len(tiles)):
+            tiles[image_index] = np.asarray(work_results[image_index]) if image_index < len(work_results) else 0
 
         combined_image = combine_grid(grid)
 
-        save_image(combined_image, p.outpath_grids, "grid", initial_seed, prompt, opts.grid_format, info=str(initial_info), short_filename=not opts.grid_extended_filename)
+        grid_save = save_image_in_background(combined_image, p.outpath_grids, "grid", initial_seed, prompt, opts.grid_format, info=str(initial_info), short_filename=not opts.grid_extended_filename)
 
         processed = Processed(p, [combined_image], initial_seed, initial_info)
 
     else:
         processed = process_images(p)
 
+    if grid_save is not None:
+        grid_save.result()
+
     return processed.images, processed.js(), processed.info.html()
 
-def upscale_with_realesrgan(image, RealESRGAN_upscaling, RealESRGAN_model_index):
+# keeps the most recently used upsampler (and its weights on the GPU) around between calls
+@lru_cache(maxsize=1)
+def realesrgan_upsampler(RealESRGAN_model_index):
+    from realesrgan import RealESRGANer
+
     info = realesrgan_models[RealESRGAN_model_index]
 
-    model = info.model()
-    upsampler = RealESRGANer(
+    return RealESRGANer(
         scale=info.netscale,
         model_path=info.location,
-        model=model,
+        model=info.model(),
         half=True
     )
 
-    upsampled = upsampler.enhance(np.array(image), outscale=RealESRGAN_upscaling)[0]
+
+def upscale_with_realesrgan(image, RealESRGAN_upscaling, RealESRGAN_model_index):
+    upsampler = realesrgan_upsampler(RealESRGAN_model_index)
+
+    upsampled = upsampler.enhance(np.asarray(image), outscale=RealESRGAN_upscaling)[0]
 
     image = Image.fromarray(upsampled)
     return image
@@ -1678,14 +2203,14 @@ def run_postprocessing(image, use_GFPGAN: bool, strength_GFPGAN: float, use_ESRG
     if not image:
         raise Exception('No input image provided')
 
-    image = image.convert("RGB")
+    image = to_rgb(image)
 
     outpath = opts.outdir_samples or opts.outdir_extras_samples
 
     if have_gfpgan and use_GFPGAN and strength_GFPGAN > 0:
         gfpgan_model = gfpgan()
 
-        restored_img = gfpgan_fix_faces(gfpgan_model, np.array(image, dtype=np.uint8))
+        restored_img = gfpgan_fix_faces(gfpgan_model, np.asarray(image))
         res = Image.fromarray(restored_img)
 
         if strength_GFPGAN < 1.0:
@@ -1696,7 +2221,8 @@ def run_postprocessing(image, use_GFPGAN: bool, strength_GFPGAN: float, use_ESRG
     if have_realesrgan and use_ESRGAN and scale_ESRGAN != 1.0:
         image = upscale_with_realesrgan(image, scale_ESRGAN, model_ESRGAN)
 
-    save_image(image, outpath, "", None, '', opts.samples_format, short_filename=True, no_prompt=True)
+    save = save_image_in_background(image, outpath, "", None, '', opts.samples_format, short_filename=True, no_prompt=True)
+    save.result()
 
     return [image, '']
 
@@ -1724,10 +2250,14 @@ def run_image_info(image):
 # Settings
 
 def run_settings(*args):
+    changed = False
     for key, value in zip(opts.data_labels.keys(), args):
+        changed = changed or opts.data.get(key) != value
         opts.data[key] = value
 
-    opts.save(config_filename)
+    # the settings tab always submits every setting, so the file is only rewritten if one of them is different
+    if changed or not os.path.exists(config_filename):
+        opts.save(config_filename)
 
     return plaintext_to_html(f'Settings saved @ {datetime.now().strftime("%I:%M:%S")}')
 
@@ -1761,16 +2291,46 @@ except Exception:
 
 sd_config = OmegaConf.load(cmd_opts.config)
 sd_model = load_model_from_config(sd_config, cmd_opts.ckpt)
-sd_model = (sd_model if cmd_opts.no_half else sd_model.half())
+sd_model_dtype = torch.float32 if cmd_opts.no_half else torch.float16
+
+# cuDNN convolutions are faster in NHWC; with channels_last weights, convolution outputs come out in that layout too,
+# so the NCHW noise and latents are converted by the first layer, and the rest of the network stays channels_last
+sd_model_memory_format = torch.channels_last if device.type == 'cuda' else torch.preserve_format
 
 if cmd_opts.lowvram or cmd_opts.medvram:
+    sd_model = sd_model.to(dtype=sd_model_dtype, memory_format=sd_model_memory_format)
     setup_for_low_vram(sd_model)
 else:
-    sd_model = sd_model.to(device)
+    # cast, convert and move in a single pass over the weights; each tensor is converted as it is moved, so the whole
+    # model never exists at full precision on the device
+    sd_model = sd_model.to(device, dtype=sd_model_dtype, memory_format=sd_model_memory_format)
 
 model_hijack = StableDiffusionModelHijack()
 model_hijack.hijack(sd_model)
 
+if cmd_opts.int8:
+    if cmd_opts.lowvram or cmd_opts.medvram or device.type != 'cuda':
+        # 8-bit weights are quantized when moved to the GPU and can't be moved back to the CPU
+        print("Warning: --int8 needs the whole model on a CUDA GPU; it has no effect with --lowvram, --medvram or without CUDA", file=sys.stderr)
+    else:
+        try:
+            quantize_linear_layers(sd_model.model.diffusion_model)
+        except ImportError:
+            print("Warning: --int8 needs the bitsandbytes package; running the model unquantized", file=sys.stderr)
+
+if cmd_opts.compile:
+    if not hasattr(torch, 'compile'):
+        print("Warning: --compile needs torch 2.0 or newer; running the model uncompiled", file=sys.stderr)
+    elif cmd_opts.lowvram or cmd_opts.medvram:
+        # the hooks that move modules between devices would break every compiled graph apart
+        print("Warning: --compile has no effect with --lowvram or --medvram", file=sys.stderr)
+    else:
+        sd_model.model.diffusion_model = torch.compile(sd_model.model.diffusion_model, mode=cmd_opts.compile_mode)
+        sd_model.first_stage_model.decoder = torch.compile(sd_model.first_stage_model.decoder, mode=cmd_opts.compile_mode)
+
+# thumbnails for a history entry are resized and JPEG encoded in parallel; PIL releases the GIL while doing both
+history_thumbnail_executor = ThreadPoolExecutor(max_workers=3)
+
 class HistoryEntry:
     def __init__(self, images: Image=None, description: str=None):
         self.images = images
@@ -1788,14 +2348,18 @@ class HistoryEntry:
             else:
                 thumbnail_dim = (image.width * maxres // image.height, maxres)
 
-            return image.resize(thumbnail_dim, resample=Image.Resampling.BICUBIC)
+            # as with 4chan exports, a cheap box reduction does most of the shrinking before the bicubic filter runs
+            return image.resize(thumbnail_dim, resample=Image.Resampling.BICUBIC, reducing_gap=3.0)
 
         def html(self) -> str:
             thumb = self.make_thumbnail(self.image)
             buffer = BytesIO()
 
             thumb.save(buffer, format='JPEG', quality=60)
-            img_b64 = 'data:image/jpeg;charset=utf-8;base64,' + base64.b64encode(buffer.getvalue()).decode('utf-8')
+            # getbuffer() hands the encoder the JPEG data without copying it out of the BytesIO first
+            data = buffer.getbuffer()
+            encoded = pybase64.b64encode(data) if pybase64 is not None else base64.b64encode(data)
+            img_b64 = 'data:image/jpeg;charset=utf-8;base64,' + encoded.decode('ascii')
             img_tag = f'<img id="history_img" src="{img_b64}"/>'
             img_div = f'<div id="history_thumb">{img_tag}</div>'
 
@@ -1810,7 +2374,7 @@ class HistoryEntry:
 
     def html(self):
         history_images = [HistoryEntry.HistoryImage(img) for img in self.images]
-        thumbnails_contents = ''.join([x.html() for x in history_images])
+        thumbnails_contents = ''.join(history_thumbnail_executor.map(HistoryEntry.HistoryImage.html, history_images))
         thumbnails = f'<div id="history_thumbnails">{thumbnails_contents}</div>'
 
         history_description = HistoryEntry.HistoryDescription(self.description).html()
@@ -1834,12 +2398,39 @@ def save_to_history(images, html):
     with open(history_file_path, 'a', encoding='utf-8') as fd:
         fd.write(entry.html())
 
+def read_history_entries(history_file_path, count):
+    """the last count entries of the history file, or all of them if count is 0; the file is streamed, so only the
+    entries that are kept need to be in memory at once
+    """
+    marker = '<div id="history_row">'
+    entries = deque(maxlen=count if count > 0 else None)
+
+    buffer = ''
+    with open(history_file_path, 'r', encoding='utf-8') as file:
+        for chunk in iter(lambda: file.read(1 << 16), ''):
+            buffer += chunk
+
+            # every entry starts with the marker, so an entry is complete once the next one's marker has been read
+            start = 0
+            end = buffer.find(marker, 1)
+            while end != -1:
+                entries.append(buffer[start:end])
+                start = end
+                end = buffer.find(marker, start + 1)
+
+            buffer = buffer[start:]
+
+    if buffer:
+        entries.append(buffer)
+
+    return entries
+
 def read_history():
     outdir = opts.outdir or "outputs/"
     history_file_path = os.path.join(outdir, 'history.html')
 
     if os.path.exists(history_file_path):
-        history_contents = open(history_file_path, 'r', encoding='utf-8').read()
+        history_contents = ''.join(read_history_entries(history_file_path, int(opts.history_max_shown)))
         history_container = f'<div id="history" style="display: flex; flex-direction: column-reverse;">{history_contents}</div>'
         return history_container
     else:
@@ -1951,10 +2542,12 @@ def do_generate(
 --- UI CODE ---
 '''
 
-webui_css = open('webui.css', 'r').read()
+with open('webui.css', 'r', encoding='utf-8') as file:
+    webui_css = file.read()
 
 if os.path.isfile('userstyle.css'):
-    userstyle_css = open('userstyle.css', 'r', encoding='utf-8').read()
+    with open('userstyle.css', 'r', encoding='utf-8') as file:
+        userstyle_css = file.read()
 else:
     userstyle_css = ''
 
@@ -1975,6 +2568,8 @@ history_css = f"""
 }}
 """
 
+sd_modes = ['Text-to-Image', 'Image-to-Image', 'Inpainting']
+
 # TODO: check to make sure that their aren't alignment/size issues with the inpainting mask relative to the image if the image is not square
 with gr.Blocks(css=webui_css + userstyle_css + history_css, analytics_enabled=False, title='Stable Diffusion WebUI') as demo:
     with gr.Tabs(elem_id='tabs'):
@@ -2027,7 +2622,7 @@ with gr.Blocks(css=webui_css + userstyle_css + history_css, analytics_enabled=Fa
                         sd_upscale = gr.Checkbox(label='Stable diffusion upscale', value=False, visible=False)
 
             with gr.Row(elem_id='row_buttons'):
-                sd_mode = gr.Dropdown(show_label=False, value='Text-to-Image', choices=['Text-to-Image', 'Image-to-Image', 'Inpainting'], elem_id='sd_mode')
+                sd_mode = gr.Dropdown(show_label=False, value='Text-to-Image', choices=sd_modes, elem_id='sd_mode')
                 sd_save_image = gr.Button('Save', elem_id='sd_save_image').style(full_width=False)
                 sd_generate = gr.Button('Generate', variant='primary', elem_id='sd_generate').style(full_width=False)
 
@@ -2079,32 +2674,39 @@ with gr.Blocks(css=webui_css + userstyle_css + history_css, analytics_enabled=Fa
 
 
     # Tab - Stable Diffusion - Callbacks
-    def mode_change(mode: str):
+    def mode_visibility(mode: str):
         is_img2img = (mode == 'Image-to-Image')
         is_txt2img = (mode == 'Text-to-Image')
         is_inpainting = (mode == 'Inpainting')
+        is_any = is_img2img or is_txt2img or is_inpainting
 
         return {
-            sd_cfg: gr.update(visible=is_img2img or is_txt2img or is_inpainting),
-            sd_denoise: gr.update(visible=is_img2img or is_inpainting),
+            sd_cfg: is_any,
+            sd_denoise: is_img2img or is_inpainting,
             # TODO: need to hide PLMS from smaplers if in an img2img mode
-            sd_sampling_method: gr.update(visible=is_img2img or is_txt2img or is_inpainting),
-            sd_sampling_steps: gr.update(visible=is_img2img or is_txt2img or is_inpainting),
-            sd_batch_count: gr.update(visible=is_img2img or is_txt2img or is_inpainting),
-            sd_batch_size: gr.update(visible=is_img2img or is_txt2img or is_inpainting),
-            sd_resize_mode: gr.update(visible=is_img2img or is_inpainting),
-            sd_image_height: gr.update(visible=is_img2img or is_txt2img or is_inpainting),
-            sd_image_width: gr.update(visible=is_img2img or is_txt2img or is_inpainting),
-            sd_custom_code: gr.update(visible=is_txt2img and cmd_opts.allow_code),
-            sd_matrix: gr.update(visible=is_img2img or is_txt2img),
-            sd_loopback: gr.update(visible=is_img2img),
-            sd_upscale: gr.update(visible=is_img2img),
-            sd_inpainting_mask_blur: gr.update(visible=is_inpainting),
-            sd_inpainting_mask_content: gr.update(visible=is_inpainting),
-            sd_input_image: gr.update(visible=is_img2img),
-            sd_inpainting_image: gr.update(visible=is_inpainting),
+            sd_sampling_method: is_any,
+            sd_sampling_steps: is_any,
+            sd_batch_count: is_any,
+            sd_batch_size: is_any,
+            sd_resize_mode: is_img2img or is_inpainting,
+            sd_image_height: is_any,
+            sd_image_width: is_any,
+            sd_custom_code: is_txt2img and cmd_opts.allow_code,
+            sd_matrix: is_img2img or is_txt2img,
+            sd_loopback: is_img2img,
+            sd_upscale: is_img2img,
+            sd_inpainting_mask_blur: is_inpainting,
+            sd_inpainting_mask_content: is_inpainting,
+            sd_input_image: is_img2img,
+            sd_inpainting_image: is_inpainting,
         }
 
+    # which controls each mode shows never changes while the UI runs, so it is worked out once for every mode
+    mode_visibility_table = {mode: mode_visibility(mode) for mode in sd_modes}
+
+    def mode_change(mode: str):
+        return {component: gr.update(visible=visible) for component, visible in mode_visibility_table[mode].items()}
+
     sd_mode.change(
         fn=mode_change,
         inputs=[